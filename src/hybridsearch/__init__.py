@@ -1,4 +1,6 @@
 from __future__ import annotations
 
+from hybridsearch.async_hybridsearch import AsyncHybridSearch
 from hybridsearch.hybridsearch import HybridSearch
 from hybridsearch.preprocessing import NaiveChunking, SemanticChunking
+from hybridsearch.semantic_cache import RedisVLSemanticCache, SemanticCacheProvider
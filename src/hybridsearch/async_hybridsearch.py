@@ -0,0 +1,655 @@
+from __future__ import annotations
+
+import asyncio
+
+import aiohttp
+from cachetools import TLRUCache
+from cachetools.keys import hashkey
+
+from .hybridsearch import (
+    _ACCEPT_ENCODING,
+    _ENDPOINTS,
+    _JSON_HEADERS,
+    HybridSearch,
+    _base_url,
+    _dumps,
+    _no_route,
+    _read_ttu,
+    _response,
+)
+from .preprocessing import NaiveChunking, SemanticChunking
+from .semantic_cache import (
+    SemanticCacheProvider,
+    _invalidate,
+    _lookup,
+    _namespace,
+    _store,
+)
+
+
+def _params(**params):
+    """aiohttp only accepts str, int and float query values: drop the None
+    values and send booleans the same way requests does"""
+    return {
+        key: str(value) if isinstance(value, bool) else value
+        for key, value in params.items()
+        if value is not None
+    }
+
+
+class AsyncHybridSearch:
+    def __init__(
+        self,
+        api_key: str,
+        url: str = "localhost",
+        port: int = 8000,
+        semantic_cache: SemanticCacheProvider | None = None,
+    ):
+        """This class is the asyncio version of HybridSearch, it is used to
+        interact with the microservice typesense+fastapi
+
+        The connection pool is opened on the first call made from an event
+        loop. The client can be used as an async context manager, which also
+        checks the API key and closes the pool on exit:
+
+            async with AsyncHybridSearch(api_key) as hs:
+                await hs.semantic_search(...)
+
+        Without the context manager, await close() before the event loop
+        ends.
+
+        Args:
+            api_key (str): API key to access the database
+            url (str, optional): Host of the microservice, or its full URL
+                with the scheme (e.g. "https://search.example.com"). Defaults
+                to "localhost".
+            port (int, optional): Port of the microservice, ignored when url
+                is a full URL. Defaults to 8000.
+            semantic_cache (SemanticCacheProvider, optional): cache answering
+                the searches of queries similar to ones already searched with
+                the same settings. Defaults to None.
+        """
+
+        self.api_key = api_key
+        self.port = port
+        self.url = url
+        self.semantic_cache = semantic_cache
+        self._base = _base_url(url, port)
+        # absolute urls, aiohttp's base_url would drop the path of the url
+        self._urls = {name: self._base + path for name, path in _ENDPOINTS.items()}
+        self._session = None
+        self._loop = None
+
+        # the bodies of the successful answers of the read-only endpoints are
+        # kept for a short time, writes evict the entries they make stale.
+        # Every call decodes its own copy, callers can change what they get
+        self._read_cache = TLRUCache(maxsize=256, ttu=_read_ttu)
+        # identical reads issued at the same time share a single request
+        self._inflight: dict[tuple, asyncio.Future] = {}
+        # bumped by every eviction, a read that was in flight during one may
+        # hold stale data and is not cached
+        self._generation = 0
+        # cleared when the microservice answers that it has no bulk endpoint,
+        # the documents are then created one by one
+        self._bulk = True
+
+    def _client(self):
+        """Returns the session of the running event loop, creating it on the
+        first call (aiohttp sessions can not be shared between loops)"""
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            if self._session is not None and self._loop is not loop:
+                self._drop_session()
+            self._session = aiohttp.ClientSession(
+                headers={
+                    "x-typesense-api-key": self.api_key,
+                    "Accept-Encoding": _ACCEPT_ENCODING,
+                },
+                connector=aiohttp.TCPConnector(
+                    limit=100, limit_per_host=32, keepalive_timeout=30
+                ),
+                auto_decompress=True,
+            )
+            self._loop = loop
+        return self._session
+
+    def _drop_session(self):
+        """Lets go of the session of a previous event loop, with the reads it
+        had in flight"""
+        if not self._session.closed:
+            if self._loop.is_closed():
+                # its connections died with the loop, only mark the connector
+                # closed so it is not reported as leaked
+                self._session.connector._close()
+            else:
+                asyncio.run_coroutine_threadsafe(self._session.close(), self._loop)
+        self._inflight.clear()
+
+    async def __aenter__(self):
+        # the keys accepted by the microservice are shared with HybridSearch
+        if (self._base, self.api_key) in HybridSearch._validated_keys:
+            return self
+        try:
+            await self.check_api_key()
+        except Exception:
+            await self.close()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        """This function closes the connections opened by the client"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+            self._loop = None
+
+    def invalidate(self, prefix=None):
+        """This function removes the cached answers of the read-only methods
+
+        Args:
+            prefix (str, optional): name of the method whose answers are
+                removed, e.g. "get_collection". Defaults to None (all of them).
+        """
+        self._generation += 1
+        # the reads in flight are not joined by the later callers either
+        if prefix is None:
+            self._read_cache.clear()
+            self._inflight.clear()
+            return
+        for cache in (self._read_cache, self._inflight):
+            for key in [key for key in cache if key[0] == prefix]:
+                cache.pop(key, None)
+
+    async def _evict(self, collection_name):
+        """Removes the cached answers made stale by a write on a collection"""
+        self.invalidate("get_all_collections")
+        key = hashkey("get_collection", collection_name)
+        self._read_cache.pop(key, None)
+        self._inflight.pop(key, None)
+        if self.semantic_cache is not None and collection_name is not None:
+            # the cache providers are blocking, keep them off the event loop
+            await asyncio.to_thread(_invalidate, self.semantic_cache, collection_name)
+
+    async def _read(self, key, url):
+        """Serves a read-only call from the cache, or performs the GET request
+        and caches the answer if it is successful. Callers asking for a key
+        that is already being fetched wait for that request instead of
+        sending their own"""
+        body = self._read_cache.get(key)
+        if body is not None:
+            return _response(200, body)
+
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch(key, url, self._generation))
+            self._inflight[key] = future
+            future.add_done_callback(lambda done: self._forget(key, done))
+        # a cancelled caller must not cancel the request the others wait for
+        return _response(*await asyncio.shield(future))
+
+    def _forget(self, key, future):
+        """Drops a finished read from the ones in flight, unless an eviction
+        already replaced it by a newer one"""
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+
+    async def _fetch(self, key, url, generation):
+        async with self._client().get(url) as response:
+            answer = (response.status, await response.read())
+        if answer[0] == 200 and self._generation == generation:
+            self._read_cache[key] = answer[1]
+        return answer
+
+    async def _unwrap(self, response, ok_desc=None):
+        """Builds the {"status", "description"} answer of a response, the
+        description of an error is the "detail" sent by the microservice"""
+        return _response(response.status, await response.read(), ok_desc)
+
+    async def _search(self, endpoint, collection_name, query, settings, **kwargs):
+        """Performs a search, serving it from the semantic cache when one is
+        configured. settings are the parameters, other than the query, that
+        change the results"""
+        if self.semantic_cache is None:
+            async with self._client().post(self._urls[endpoint], **kwargs) as response:
+                return await self._unwrap(response)
+
+        # the cache providers are blocking, keep them off the event loop
+        namespace = _namespace(endpoint, *settings)
+        cached = await asyncio.to_thread(
+            _lookup, self.semantic_cache, query, collection_name, namespace
+        )
+        if cached is not None:
+            return {"status": 200, "description": cached}
+
+        async with self._client().post(self._urls[endpoint], **kwargs) as response:
+            result = await self._unwrap(response)
+        if result["status"] == 200:
+            await asyncio.to_thread(
+                _store,
+                self.semantic_cache,
+                query,
+                collection_name,
+                namespace,
+                result["description"],
+            )
+        return result
+
+    async def check_api_key(self):
+        """
+        This function checks if the API key is valid
+
+        Raises
+        ------
+        Exception: If the API key is invalid
+        """
+        async with self._client().get(self._urls["api_key"]) as response:
+            if response.status != 200:
+                HybridSearch._validated_keys.discard((self._base, self.api_key))
+                raise Exception("Invalid API Key")
+        HybridSearch._validated_keys.add((self._base, self.api_key))
+
+    async def get_all_collections(self):
+        """This function returns all the collections in the database
+
+        Returns:
+            json: response with all the collections
+        """
+        return await self._read(
+            hashkey("get_all_collections"), self._urls["collections"]
+        )
+
+    async def get_collection(self, collection_name):
+        """This function returns the collection with the given name
+
+        Args:
+            collection_name (str): Name of the collection
+
+        Returns:
+            json: response with the collection information
+        """
+        return await self._read(
+            hashkey("get_collection", collection_name),
+            f"{self._urls['collections']}/{collection_name}",
+        )
+
+    async def create_custom_collection(
+        self, embedding_field: str, model_name: str, schema: dict
+    ):
+        """This function creates a collection in the database
+
+        Args:
+            embedding_field (str, required): field to embed
+            model_name (str, required): model  name used to embed the field
+            schema (dict, required): schema of the fields
+
+        Returns:
+            json: response of the created collection
+        """
+        async with self._client().post(
+            self._urls["create_collection_custom"],
+            params=_params(embedding_field=embedding_field, model_name=model_name),
+            data=_dumps(schema),
+            headers=_JSON_HEADERS,
+        ) as response:
+            await self._evict(schema.get("name"))
+            return await self._unwrap(response)
+
+    async def create_collection(self, collection_name):
+        """This function creates a general collection in the database,
+        with a field text with is autoembeded with the model name e5-small
+
+        Args:
+            collection_name (str, required): Name of the collection
+        Returns:
+            response: dict
+        """
+        async with self._client().post(
+            self._urls["create_collection"], params=_params(name=collection_name)
+        ) as response:
+            await self._evict(collection_name)
+            return await self._unwrap(response)
+
+    async def create_document(self, collection_name: str, schema: dict):
+        """This function creates a document in the collection
+
+        Args:
+            collection_name (str): Name of the collection
+
+        Returns:
+            json: response
+        """
+        response = await self._post_document(collection_name, schema)
+        await self._evict(collection_name)
+        return response
+
+    async def _post_document(self, collection_name, schema):
+        """Sends a document to the microservice without evicting the caches,
+        the caller does it once for all the documents it creates"""
+        async with self._client().post(
+            self._urls["create_document"],
+            params=_params(name=collection_name),
+            data=_dumps(schema),
+            headers=_JSON_HEADERS,
+        ) as response:
+            return await self._unwrap(response, "Document created successfully")
+
+    async def create_documents(
+        self, collection_name: str, schemas: list, batch_size: int = 500
+    ):
+        """This function creates many documents in the collection, sending
+        them in batches. The first batch is sent alone, and once it succeeded
+        the others are uploaded concurrently. If the microservice has no bulk
+        endpoint, the documents are created concurrently one by one
+
+        Args:
+            collection_name (str): Name of the collection
+            schemas (list): documents to insert
+            batch_size (int, optional): documents sent with each request.
+                Defaults to 500.
+
+        Returns:
+            json: response, on success the description holds the result of
+                each document in the same order as schemas
+        """
+
+        async def send(batch):
+            async with self._client().post(
+                self._urls["create_documents_bulk"],
+                params=_params(name=collection_name),
+                data=_dumps(batch),
+                headers=_JSON_HEADERS,
+            ) as response:
+                return await self._unwrap(response)
+
+        if not self._bulk:
+            return await self._create_each(collection_name, schemas)
+
+        batches = [
+            schemas[i : i + batch_size] for i in range(0, len(schemas), batch_size)
+        ]
+        # the first batch finds out whether the bulk endpoint exists, so the
+        # others are not all sent to a missing route
+        responses = [await send(batch) for batch in batches[:1]]
+        if responses and _no_route(responses[0]):
+            self._bulk = False
+            return await self._create_each(collection_name, schemas)
+
+        if responses and responses[0]["status"] == 200:
+            responses.extend(await asyncio.gather(*(send(b) for b in batches[1:])))
+        await self._evict(collection_name)
+
+        results = []
+        for response in responses:
+            if response["status"] != 200:
+                return response
+            results.extend(response["description"])
+        return {"status": 200, "description": results}
+
+    async def _create_each(self, collection_name, schemas):
+        """Creates the documents concurrently with one request each, for the
+        microservices without the bulk endpoint. Answers like create_documents"""
+        responses = await asyncio.gather(
+            *(self._post_document(collection_name, schema) for schema in schemas)
+        )
+        await self._evict(collection_name)
+
+        for response in responses:
+            if response["status"] != 200:
+                return response
+        return {
+            "status": 200,
+            "description": [response["description"] for response in responses],
+        }
+
+    async def create_document_from_file(
+        self,
+        collection_name: str,
+        file_path: str,
+        field: str,
+        chunk_mode: str = "naive",  # naive or semantic
+        chunk_size: int = 1000,
+        overlap_size=200,
+        mode: str = "words",
+        model_to_semantic_chunk: str = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2",
+    ):
+        """This function creates documents from a pdf file, the chunks are
+        uploaded in batches with create_documents
+
+        Args:
+            collection_name (str): collection name
+            file_path (str): path to the file
+            field (str): field to insert the text
+            chunk_mode (str, optional): chunk mode. Defaults to "naive".
+            chunk_size (int, optional): chunk size. Defaults to 1000.
+            overlap_size (int, optional): overlap size. Defaults to 200.
+            mode (str, optional): mode. Defaults to "words".
+            model_to_semantic_chunk (str, optional): model to semantic chunk. Defaults to "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2".
+        """
+
+        if chunk_mode not in ["naive", "semantic"]:
+            raise ValueError("chunk_mode should be 'naive' or 'semantic'")
+
+        if chunk_mode == "semantic":
+            if model_to_semantic_chunk == "":
+                raise ValueError("model_to_semantic_chunk should be provided")
+
+            # loading the model imports torch and reads its weights, keep it
+            # off the event loop together with the chunking
+            chunks, _ = await asyncio.to_thread(
+                lambda: SemanticChunking(
+                    file_path, model_to_semantic_chunk
+                ).create_chunks()
+            )
+
+        if chunk_mode == "naive":
+            if mode not in ["words", "characters"]:
+                raise ValueError("mode should be 'words' or 'characters'")
+            chunker = NaiveChunking(file_path, chunk_size, overlap_size, mode)
+            chunks = await asyncio.to_thread(chunker.create_chunks)
+
+        schemas = [
+            {
+                field: chunk["text"],
+                "page": chunk["page"],
+                "start_line": chunk["start_line"],
+                "end_line": chunk["end_line"],
+            }
+            for chunk in chunks
+        ]
+        return await self.create_documents(collection_name, schemas)
+
+    async def delete_collection(self, collection_name):
+        """This function deletes the collection with the given name
+
+        Args:
+            collection_name (str): Name of the collection
+
+        Returns:
+            json: response
+        """
+        async with self._client().delete(
+            f"{self._urls['delete_collection']}/{collection_name}"
+        ) as response:
+            await self._evict(collection_name)
+            return await self._unwrap(response, "Collection deleted")
+
+    async def semantic_search(
+        self,
+        collection_name: str,
+        query: str,
+        num_results: int,
+        rerank: bool = False,
+        rerank_model: str = None,
+    ):
+        """This function performs a semantic search on the collection
+
+        Args:
+            collection_name (str): Name of the collection
+            query (str): Query to search
+            num_results (int): Number of results
+
+        Returns:
+            json: response
+        """
+        return await self._search(
+            "semantic_search",
+            collection_name,
+            query,
+            (collection_name, num_results, rerank, rerank_model),
+            params=_params(
+                collection_name=collection_name,
+                query=query,
+                num_results=num_results,
+                rerank=rerank,
+                rerank_model=rerank_model,
+            ),
+        )
+
+    async def hybrid_search(
+        self,
+        collection_name: str,
+        query: str,
+        num_results: int,
+        field: str,
+        rerank: bool = False,
+        rerank_model: str = None,
+    ):
+        """This function performs a hybrid search on the collection, combining semantic search and full text search
+        on a field or fields choose by the user
+
+        Args:
+            collection_name (str): Name of the collection
+            query (str): Query to search
+            num_results (int): Number of results
+            field (str): fields to search
+            rerank (bool, optional): If True, rerank the results. Defaults to False.
+            rerank_model (str, optional): Model to rerank the results. Defaults to None.
+        Returns:
+            response: json
+        """
+        return await self._search(
+            "hybrid_search",
+            collection_name,
+            query,
+            (collection_name, num_results, field, rerank, rerank_model),
+            params=_params(
+                collection_name=collection_name,
+                query=query,
+                num_results=num_results,
+                search_field=field,
+                rerank=rerank,
+                rerank_model=rerank_model,
+            ),
+        )
+
+    async def hybrid_search_filter(
+        self,
+        collection_name: str,
+        query: str,
+        num_results: int,
+        field: str,
+        rerank: bool = False,
+        rerank_model: str = None,
+        filters: list = None,
+    ):
+        """This function performs a hybrid search on the collection, combining semantic search and full text search
+        on a field or fields choose by the user
+
+        Args:
+            collection_name (str): Name of the collection
+            query (str): Query to search
+            num_results (int): Number of results
+            field (str): fields to search
+            rerank (bool, optional): If True, rerank the results. Defaults to False.
+            rerank_model (str, optional): Model to rerank the results. Defaults to None.
+        Returns:
+            response: json
+        """
+
+        payload = {
+            "collection_name": collection_name,
+            "query": query,
+            "num_results": num_results,
+            "search_field": field,
+            "rerank": rerank,
+            "rerank_model": rerank_model,
+            "filters": filters,
+        }
+        return await self._search(
+            "hybrid_search_filter",
+            collection_name,
+            query,
+            (collection_name, num_results, field, rerank, rerank_model, filters),
+            data=_dumps(payload),
+            headers=_JSON_HEADERS,
+        )
+
+    async def iter_search(
+        self,
+        collection_name: str,
+        query: str,
+        num_results: int,
+        field: str = None,
+        rerank: bool = False,
+        rerank_model: str = None,
+    ):
+        """This function performs a semantic search, or a hybrid search when a
+        field is given, and yields the results while they are downloaded
+        instead of loading the whole answer in memory. The semantic cache is
+        not used. Requires the optional dependency ijson (extra "streaming").
+
+        Args:
+            collection_name (str): Name of the collection
+            query (str): Query to search
+            num_results (int): Number of results
+            field (str, optional): fields to search, if given a hybrid search
+                is performed. Defaults to None.
+            rerank (bool, optional): If True, rerank the results. Defaults to False.
+            rerank_model (str, optional): Model to rerank the results. Defaults to None.
+
+        Yields:
+            dict: a result of the search
+
+        Raises:
+            Exception: If the microservice returns an error
+        """
+        import ijson
+
+        endpoint = "semantic_search" if field is None else "hybrid_search"
+        params = _params(
+            collection_name=collection_name,
+            query=query,
+            num_results=num_results,
+            search_field=field,
+            rerank=rerank,
+            rerank_model=rerank_model,
+        )
+        async with self._client().post(self._urls[endpoint], params=params) as response:
+            if response.status != 200:
+                raise Exception((await self._unwrap(response))["description"])
+            # floats, not Decimal, so the results equal the semantic_search ones
+            async for hit in ijson.items(response.content, "item", use_float=True):
+                yield hit
+
+    async def get_model_name(self):
+        """This function returns the model name used to embed
+
+        Returns:
+            response: json with a list of the models used for embedding
+        """
+        return await self._read(
+            hashkey("get_model_name"), self._urls["embedding_models"]
+        )
+
+    async def get_rerank_model_name(self):
+        """This function returns the model name used to rerank
+
+        Returns:
+            response: json with a list of the models used for embedding
+        """
+        return await self._read(
+            hashkey("get_rerank_model_name"), self._urls["rerank_models"]
+        )
@@ -2,27 +2,302 @@ from __future__ import annotations
 
 import json
 import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import requests as req
+from cachetools import TLRUCache
+from cachetools.keys import hashkey
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from .preprocessing import NaiveChunking, SemanticChunking
+from .semantic_cache import (
+    SemanticCacheProvider,
+    _invalidate,
+    _lookup,
+    _namespace,
+    _store,
+)
+
+try:
+    # optional, installed with the "speedups" extra
+    import orjson
+
+    _loads = orjson.loads
+
+    def _dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+
+except ImportError:
+    _loads = json.loads
+
+    def _dumps(obj):
+        return json.dumps(obj, allow_nan=False).encode()
+
+
+try:
+    # optional, installed with the "speedups" extra, urllib3 and aiohttp decode
+    # brotli answers only when it is available
+    import brotli  # noqa: F401
+
+    _ACCEPT_ENCODING = "gzip, deflate, br"
+except ImportError:
+    _ACCEPT_ENCODING = "gzip, deflate"
+
+# request bodies are serialized with _dumps and sent as data=
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+# paths of the microservice endpoints, relative to its base url
+_ENDPOINTS = {
+    "api_key": "/api-key",
+    "collections": "/collections",
+    "create_collection_custom": "/create-collection-custom",
+    "create_collection": "/create-collection",
+    "create_document": "/create-document",
+    "create_documents_bulk": "/create-documents-bulk",
+    "delete_collection": "/collections-delete",
+    "semantic_search": "/collections-semanticsearch",
+    "hybrid_search": "/collections-hybridsearch/",
+    "hybrid_search_filter": "/hybridsearch_filter/",
+    "embedding_models": "/embedding_models",
+    "rerank_models": "/rerank_models",
+}
+
+# the model lists rarely change, they are cached longer than the other reads
+_STATIC_READS = frozenset({"get_model_name", "get_rerank_model_name"})
+
+
+def _base_url(url, port):
+    """Builds the base url of the microservice from its host and port, a full
+    url with its scheme is used as it is"""
+    if "://" in url:
+        return url.rstrip("/")
+    return f"http://{url}:{port}"
+
+
+def _read_ttu(key, value, now):
+    """Expiration time of a cached read"""
+    return now + (300 if key[0] in _STATIC_READS else 60)
+
+
+def _no_route(answer):
+    """True if the microservice has no route for the request, i.e. it is older
+    than the endpoint (FastAPI answers "Not Found" for an unknown path)"""
+    return answer["status"] == 405 or answer == {
+        "status": 404,
+        "description": "Not Found",
+    }
+
+
+def _response(status, body, ok_desc=None):
+    """Builds the answer of a request from its status and body bytes, the
+    description of an error is the "detail" sent by the microservice"""
+    if status == 200:
+        if ok_desc is None:
+            ok_desc = _loads(body)
+        return {"status": 200, "description": ok_desc}
+    try:
+        error = _loads(body)
+    except ValueError:
+        error = None
+    if isinstance(error, dict):
+        detail = error.get("detail")
+    else:
+        # not an answer of the microservice (e.g. a proxy error page), it
+        # always answers in UTF-8, decoding the bytes directly skips the
+        # charset detection of response.text
+        detail = body.decode("utf-8", "replace")
+    return {"status": status, "description": detail}
 
 
 class HybridSearch:
-    def __init__(self, api_key: str, url: str = "localhost", port: int = 8000):
+    # (base url, api key) pairs already accepted by the microservice in this
+    # process, new clients for them skip the check in __init__
+    _validated_keys: set[tuple[str, str]] = set()
+
+    def __init__(
+        self,
+        api_key: str,
+        url: str = "localhost",
+        port: int = 8000,
+        pool_maxsize: int = 64,
+        semantic_cache: SemanticCacheProvider | None = None,
+    ):
         """This class is used to interact with the microservice typesense+fastapi
 
         Args:
             api_key (str): API key to access the database
-            url (str, optional): URL of the microservice. Defaults to "localhost".
-            port (int, optional): Port of the microservice. Defaults to 8000.
+            url (str, optional): Host of the microservice, or its full URL
+                with the scheme (e.g. "https://search.example.com"). Defaults
+                to "localhost".
+            port (int, optional): Port of the microservice, ignored when url
+                is a full URL. Defaults to 8000.
+            pool_maxsize (int, optional): Maximum number of connections kept
+                open to the microservice, raise it when the client is shared
+                by more threads. Defaults to 64.
+            semantic_cache (SemanticCacheProvider, optional): cache answering
+                the searches of queries similar to ones already searched with
+                the same settings. Defaults to None.
         """
 
         self.api_key = api_key
         self.port = port
         self.url = url
+        self.semantic_cache = semantic_cache
+        self._base = _base_url(url, port)
+        self._urls = {name: self._base + path for name, path in _ENDPOINTS.items()}
+
+        # a single session keeps the connections to the microservice alive
+        # between calls instead of opening a new one for every request
+        self._session = req.Session()
+        self._session.headers.update(
+            {
+                "x-typesense-api-key": api_key,
+                # search answers are large JSON documents, let the server
+                # compress them
+                "Accept-Encoding": _ACCEPT_ENCODING,
+                "Connection": "keep-alive",
+            }
+        )
+        # only the idempotent requests are retried on a transient failure, the
+        # last answer is returned as it is when the retries run out
+        retry = Retry(
+            total=3,
+            backoff_factor=0.2,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(["GET", "DELETE"]),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=4, pool_maxsize=pool_maxsize, max_retries=retry
+        )
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+        # the bodies of the successful answers of the read-only endpoints are
+        # kept for a short time, writes evict the entries they make stale.
+        # Every call decodes its own copy, callers can change what they get
+        self._read_cache = TLRUCache(maxsize=256, ttu=_read_ttu)
+        # identical reads issued at the same time share a single request
+        self._inflight: dict[tuple, Future] = {}
+        self._inflight_lock = threading.RLock()
+        # bumped by every eviction, a read that was in flight during one may
+        # hold stale data and is not cached
+        self._generation = 0
+        # cleared when the microservice answers that it has no bulk endpoint,
+        # the documents are then created one by one
+        self._bulk = True
+
+        if (self._base, api_key) not in HybridSearch._validated_keys:
+            # the caller gets no client to close when the key is refused
+            try:
+                self.check_api_key()
+            except Exception:
+                self.close()
+                raise
+
+    def close(self):
+        """This function closes the connections opened by the client"""
+        self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def invalidate(self, prefix=None):
+        """This function removes the cached answers of the read-only methods
 
-        self.check_api_key()
+        Args:
+            prefix (str, optional): name of the method whose answers are
+                removed, e.g. "get_collection". Defaults to None (all of them).
+        """
+        with self._inflight_lock:
+            self._generation += 1
+            # the reads in flight are not joined by the later callers either
+            if prefix is None:
+                self._read_cache.clear()
+                self._inflight.clear()
+                return
+            for cache in (self._read_cache, self._inflight):
+                for key in [key for key in cache if key[0] == prefix]:
+                    cache.pop(key, None)
+
+    def _evict(self, collection_name):
+        """Removes the cached answers made stale by a write on a collection"""
+        with self._inflight_lock:
+            self.invalidate("get_all_collections")
+            key = hashkey("get_collection", collection_name)
+            self._read_cache.pop(key, None)
+            self._inflight.pop(key, None)
+        if self.semantic_cache is not None and collection_name is not None:
+            _invalidate(self.semantic_cache, collection_name)
+
+    def _unwrap(self, response, ok_desc=None):
+        """Builds the {"status", "description"} answer of a response, the
+        description of an error is the "detail" sent by the microservice"""
+        return _response(response.status_code, response.content, ok_desc)
+
+    def _read(self, key, url):
+        """Serves a read-only call from the cache, or performs the GET request
+        and caches the answer if it is successful. Callers asking for a key
+        that is already being fetched wait for that request instead of
+        sending their own"""
+        with self._inflight_lock:
+            body = self._read_cache.get(key)
+            if body is not None:
+                return _response(200, body)
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+                generation = self._generation
+
+        if not leader:
+            return _response(*future.result())
+
+        try:
+            response = self._session.get(url)
+            answer = (response.status_code, response.content)
+        except BaseException as e:
+            with self._inflight_lock:
+                if self._inflight.get(key) is future:
+                    del self._inflight[key]
+            future.set_exception(e)
+            raise
+
+        with self._inflight_lock:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+            if answer[0] == 200 and self._generation == generation:
+                self._read_cache[key] = answer[1]
+        future.set_result(answer)
+        return _response(*answer)
+
+    def _search(self, endpoint, collection_name, query, settings, **kwargs):
+        """Performs a search, serving it from the semantic cache when one is
+        configured. settings are the parameters, other than the query, that
+        change the results"""
+        if self.semantic_cache is None:
+            return self._unwrap(self._session.post(self._urls[endpoint], **kwargs))
+
+        namespace = _namespace(endpoint, *settings)
+        cached = _lookup(self.semantic_cache, query, collection_name, namespace)
+        if cached is not None:
+            return {"status": 200, "description": cached}
+
+        result = self._unwrap(self._session.post(self._urls[endpoint], **kwargs))
+        if result["status"] == 200:
+            _store(
+                self.semantic_cache,
+                query,
+                collection_name,
+                namespace,
+                result["description"],
+            )
+        return result
 
     def check_api_key(self):
         """
@@ -32,12 +307,11 @@ class HybridSearch:
         ------
         Exception: If the API key is invalid
         """
-        status_code = req.get(
-            f"http://{self.url}:{self.port}/api-key",
-            headers={"x-typesense-api-key": self.api_key},
-        ).status_code
+        status_code = self._session.get(self._urls["api_key"]).status_code
         if status_code != 200:
+            HybridSearch._validated_keys.discard((self._base, self.api_key))
             raise Exception("Invalid API Key")
+        HybridSearch._validated_keys.add((self._base, self.api_key))
 
     def get_all_collections(self):
         """This function returns all the collections in the database
@@ -45,18 +319,7 @@ class HybridSearch:
         Returns:
             json: response with all the collections
         """
-        response = req.get(
-            f"http://{self.url}:{self.port}/collections",
-            headers={"x-typesense-api-key": self.api_key},
-        )
-
-        if response.status_code == 200:
-            return {"status": 200, "description": response.json()}
-        else:
-            return {
-                "status": response.status_code,
-                "description": json.loads(response.text)["detail"],
-            }
+        return self._read(hashkey("get_all_collections"), self._urls["collections"])
 
     def get_collection(self, collection_name):
         """This function returns the collection with the given name
@@ -67,19 +330,11 @@ class HybridSearch:
         Returns:
             json: response with the collection information
         """
-        response = req.get(
-            f"http://{self.url}:{self.port}/collections/{collection_name}",
-            headers={"x-typesense-api-key": self.api_key},
+        return self._read(
+            hashkey("get_collection", collection_name),
+            f"{self._urls['collections']}/{collection_name}",
         )
 
-        if response.status_code == 200:
-            return {"status": response.status_code, "description": response.json()}
-        else:
-            return {
-                "status": response.status_code,
-                "description": json.loads(response.text)["detail"],
-            }
-
     def create_custom_collection(
         self, embedding_field: str, model_name: str, schema: dict
     ):
@@ -94,23 +349,18 @@ class HybridSearch:
             json: response of the created collection
         """
 
-        response = req.post(
-            f"http://{self.url}:{self.port}/create-collection-custom",
-            headers={"x-typesense-api-key": self.api_key},
+        response = self._session.post(
+            self._urls["create_collection_custom"],
             params={
                 "embedding_field": embedding_field,
                 "model_name": model_name,
             },
-            json=schema,
+            data=_dumps(schema),
+            headers=_JSON_HEADERS,
         )
+        self._evict(schema.get("name"))
 
-        if response.status_code == 200:
-            return {"status": response.status_code, "description": response.json()}
-        else:
-            return {
-                "status": response.status_code,
-                "description": json.loads(response.text)["detail"],
-            }
+        return self._unwrap(response)
 
     def create_collection(self, collection_name):
         """This function creates a general collection in the database,
@@ -121,19 +371,13 @@ class HybridSearch:
         Returns:
             response: dict
         """
-        response = req.post(
-            f"http://{self.url}:{self.port}/create-collection",
-            headers={"x-typesense-api-key": self.api_key},
+        response = self._session.post(
+            self._urls["create_collection"],
             params={"name": collection_name},
         )
+        self._evict(collection_name)
 
-        if response.status_code == 200:
-            return {"status": response.status_code, "description": response.json()}
-        else:
-            return {
-                "status": response.status_code,
-                "description": json.loads(response.text)["detail"],
-            }
+        return self._unwrap(response)
 
     def create_document(self, collection_name: str, schema: dict):
         """This function creates a document in the collection
@@ -144,18 +388,108 @@ class HybridSearch:
         Returns:
             json: response
         """
-        response = req.post(
-            f"http://{self.url}:{self.port}/create-document",
-            headers={"x-typesense-api-key": self.api_key},
+        response = self._post_document(collection_name, schema)
+        self._evict(collection_name)
+
+        return response
+
+    def _post_document(self, collection_name, schema):
+        """Sends a document to the microservice without evicting the caches,
+        the caller does it once for all the documents it creates"""
+        response = self._session.post(
+            self._urls["create_document"],
             params={"name": collection_name},
-            json=schema,
+            data=_dumps(schema),
+            headers=_JSON_HEADERS,
         )
+        return self._unwrap(response, "Document created successfully")
+
+    def create_documents(
+        self,
+        collection_name: str,
+        schemas: list,
+        batch_size: int = 500,
+        max_workers: int = 8,
+    ):
+        """This function creates many documents in the collection, sending
+        them in batches instead of one request per document. The first batch
+        is sent alone, and once it succeeded the others are uploaded by a pool
+        of threads. If the microservice has no bulk endpoint, the documents are
+        created one by one, by the same pool when there are more than 4
+
+        Args:
+            collection_name (str): Name of the collection
+            schemas (list): documents to insert
+            batch_size (int, optional): documents sent with each request.
+                Defaults to 500.
+            max_workers (int, optional): batches, or documents without the bulk
+                endpoint, uploaded at the same time. Defaults to 8.
+
+        Returns:
+            json: response, on success the description holds the result of
+                each document in the same order as schemas
+        """
+
+        def send(batch):
+            return self._unwrap(
+                self._session.post(
+                    self._urls["create_documents_bulk"],
+                    params={"name": collection_name},
+                    data=_dumps(batch),
+                    headers=_JSON_HEADERS,
+                )
+            )
+
+        if not self._bulk:
+            return self._create_each(collection_name, schemas, max_workers)
+
+        batches = [
+            schemas[i : i + batch_size] for i in range(0, len(schemas), batch_size)
+        ]
+        # the first batch finds out whether the bulk endpoint exists, so the
+        # others are not all sent to a missing route
+        responses = [send(batch) for batch in batches[:1]]
+        if responses and _no_route(responses[0]):
+            self._bulk = False
+            return self._create_each(collection_name, schemas, max_workers)
+
+        rest = batches[1:]
+        if responses and responses[0]["status"] == 200 and rest:
+            if len(rest) == 1:
+                responses.append(send(rest[0]))
+            else:
+                with ThreadPoolExecutor(min(max_workers, len(rest))) as executor:
+                    responses.extend(executor.map(send, rest))
+        self._evict(collection_name)
+
+        results = []
+        for response in responses:
+            if response["status"] != 200:
+                return response
+            results.extend(response["description"])
+        return {"status": 200, "description": results}
 
-        if response.status_code == 200:
-            return {"status": 200, "description": "Document created successfully"}
+    def _create_each(self, collection_name, schemas, max_workers):
+        """Creates the documents with one request each, for the microservices
+        without the bulk endpoint. Answers like create_documents"""
+
+        def send(schema):
+            return self._post_document(collection_name, schema)
+
+        # a pool is not worth starting for a handful of documents
+        if len(schemas) <= 4:
+            responses = [send(schema) for schema in schemas]
+        else:
+            with ThreadPoolExecutor(min(max_workers, len(schemas))) as executor:
+                responses = list(executor.map(send, schemas))
+        self._evict(collection_name)
+
+        for response in responses:
+            if response["status"] != 200:
+                return response
         return {
-            "status": int(response.status_code),
-            "description": json.loads(response.text)["detail"],
+            "status": 200,
+            "description": [response["description"] for response in responses],
         }
 
     def create_document_from_file(
@@ -169,7 +503,8 @@ class HybridSearch:
         mode: str = "words",
         model_to_semantic_chunk: str = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2",
     ):
-        """This function creates documents from a pdf file
+        """This function creates documents from a pdf file, the chunks are
+        uploaded in batches with create_documents
 
         Args:
             collection_name (str): collection name
@@ -198,18 +533,16 @@ class HybridSearch:
             chunker = NaiveChunking(file_path, chunk_size, overlap_size, mode)
             chunks = chunker.create_chunks()
 
-        for chunk in chunks:
-            schema = {
+        schemas = [
+            {
                 field: chunk["text"],
                 "page": chunk["page"],
                 "start_line": chunk["start_line"],
                 "end_line": chunk["end_line"],
             }
-    
-            response = self.create_document(collection_name, schema)
-            if response["status"] != 200:
-                return response
-        return response
+            for chunk in chunks
+        ]
+        return self.create_documents(collection_name, schemas)
 
     def create_documents_for_list(
         self,
@@ -242,12 +575,15 @@ class HybridSearch:
         if not os.path.exists(".tmp"):
             os.makedirs(".tmp")
 
-        for url in url_list:
-            # download the files
-            response = req.get(url)
-            pdf_name = url.split("/")[-1]
-            with open(f".tmp/{pdf_name}", "wb") as f:
-                f.write(response.content)
+        # download the files, reusing the connections when they come from the
+        # same host. The session of the client is not used so that the API
+        # key is never sent to other hosts
+        with req.Session() as downloader:
+            for url in url_list:
+                response = downloader.get(url)
+                pdf_name = url.split("/")[-1]
+                with open(f".tmp/{pdf_name}", "wb") as f:
+                    f.write(response.content)
 
         pdfs = os.listdir(".tmp")
         list_response = []
@@ -284,18 +620,12 @@ class HybridSearch:
         Returns:
             json: response
         """
-        response = req.delete(
-            f"http://{self.url}:{self.port}/collections-delete/{collection_name}",
-            headers={"x-typesense-api-key": self.api_key},
+        response = self._session.delete(
+            f"{self._urls['delete_collection']}/{collection_name}"
         )
+        self._evict(collection_name)
 
-        if response.status_code == 200:
-            return {"status": response.status_code, "description": "Collection deleted"}
-        else:
-            return {
-                "status": response.status_code,
-                "description": json.loads(response.text)["detail"],
-            }
+        return self._unwrap(response, "Collection deleted")
 
     def semantic_search(
         self,
@@ -315,9 +645,11 @@ class HybridSearch:
         Returns:
             json: response
         """
-        response = req.post(
-            f"http://{self.url}:{self.port}/collections-semanticsearch",
-            headers={"x-typesense-api-key": self.api_key},
+        return self._search(
+            "semantic_search",
+            collection_name,
+            query,
+            (collection_name, num_results, rerank, rerank_model),
             params={
                 "collection_name": collection_name,
                 "query": query,
@@ -326,13 +658,6 @@ class HybridSearch:
                 "rerank_model": rerank_model,
             },
         )
-        if response.status_code == 200:
-            return {"status": response.status_code, "description": response.json()}
-        else:
-            return {
-                "status": response.status_code,
-                "description": json.loads(response.text)["detail"],
-            }
 
     def hybrid_search(
         self,
@@ -356,9 +681,11 @@ class HybridSearch:
         Returns:
             response: json
         """
-        response = req.post(
-            f"http://{self.url}:{self.port}/collections-hybridsearch/",
-            headers={"x-typesense-api-key": self.api_key},
+        return self._search(
+            "hybrid_search",
+            collection_name,
+            query,
+            (collection_name, num_results, field, rerank, rerank_model),
             params={
                 "collection_name": collection_name,
                 "query": query,
@@ -368,13 +695,6 @@ class HybridSearch:
                 "rerank_model": rerank_model,
             },
         )
-        if response.status_code == 200:
-            return {"status": response.status_code, "description": response.json()}
-        else:
-            return {
-                "status": response.status_code,
-                "description": json.loads(response.text)["detail"],
-            }
 
     def hybrid_search_filter(
         self,
@@ -409,19 +729,66 @@ class HybridSearch:
             "rerank_model": rerank_model,
             "filters": filters,
         }
-        response = req.post(
-            f"http://{self.url}:{self.port}/hybridsearch_filter/",
-            headers={"x-typesense-api-key": self.api_key},
-            json=payload,
+        return self._search(
+            "hybrid_search_filter",
+            collection_name,
+            query,
+            (collection_name, num_results, field, rerank, rerank_model, filters),
+            data=_dumps(payload),
+            headers=_JSON_HEADERS,
         )
 
-        if response.status_code == 200:
-            return {"status": response.status_code, "description": response.json()}
+    def iter_search(
+        self,
+        collection_name: str,
+        query: str,
+        num_results: int,
+        field: str = None,
+        rerank: bool = False,
+        rerank_model: str = None,
+    ):
+        """This function performs a semantic search, or a hybrid search when a
+        field is given, and yields the results while they are downloaded
+        instead of loading the whole answer in memory. The semantic cache is
+        not used. Requires the optional dependency ijson (extra "streaming").
+
+        Args:
+            collection_name (str): Name of the collection
+            query (str): Query to search
+            num_results (int): Number of results
+            field (str, optional): fields to search, if given a hybrid search
+                is performed. Defaults to None.
+            rerank (bool, optional): If True, rerank the results. Defaults to False.
+            rerank_model (str, optional): Model to rerank the results. Defaults to None.
+
+        Yields:
+            dict: a result of the search
+
+        Raises:
+            Exception: If the microservice returns an error
+        """
+        import ijson
+
+        params = {
+            "collection_name": collection_name,
+            "query": query,
+            "num_results": num_results,
+            "rerank": rerank,
+            "rerank_model": rerank_model,
+        }
+        if field is None:
+            url = self._urls["semantic_search"]
         else:
-            return {
-                "status": response.status_code,
-                "description": json.loads(response.text)["detail"],
-            }
+            url = self._urls["hybrid_search"]
+            params["search_field"] = field
+
+        with self._session.post(url, params=params, stream=True) as response:
+            if response.status_code != 200:
+                raise Exception(self._unwrap(response)["description"])
+            # let urllib3 undo the gzip/brotli encoding while ijson reads
+            response.raw.decode_content = True
+            # floats, not Decimal, so the results equal the semantic_search ones
+            yield from ijson.items(response.raw, "item", use_float=True)
 
     def get_model_name(self):
         """This function returns the model name used to embed
@@ -429,18 +796,7 @@ class HybridSearch:
         Returns:
             response: json with a list of the models used for embedding
         """
-        response = req.get(
-            f"http://{self.url}:{self.port}/embedding_models",
-            headers={"x-typesense-api-key": self.api_key},
-        )
-
-        if response.status_code == 200:
-            return {"status": response.status_code, "description": response.json()}
-        else:
-            return {
-                "status": response.status_code,
-                "description": json.loads(response.text)["detail"],
-            }
+        return self._read(hashkey("get_model_name"), self._urls["embedding_models"])
 
     def get_rerank_model_name(self):
         """This function returns the model name used to rerank
@@ -448,15 +804,4 @@ class HybridSearch:
         Returns:
             response: json with a list of the models used for embedding
         """
-        response = req.get(
-            f"http://{self.url}:{self.port}/rerank_models",
-            headers={"x-typesense-api-key": self.api_key},
-        )
-
-        if response.status_code == 200:
-            return {"status": response.status_code, "description": response.json()}
-        else:
-            return {
-                "status": response.status_code,
-                "description": json.loads(response.text)["detail"],
-            }
+        return self._read(hashkey("get_rerank_model_name"), self._urls["rerank_models"])
@@ -1,22 +1,68 @@
 from __future__ import annotations
 
+import functools
+import hashlib
+import os
 import re
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, repeat
+from typing import TYPE_CHECKING
 
 import fitz  # PyMuPDF
 import numpy as np
 
-# import pypdf as pypdf
 # from semantic_chunkers import StatisticalChunker
 # from semantic_router.encoders import HuggingFaceEncoder
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
+
+if TYPE_CHECKING:
+    # imported when a model is loaded, it pulls in torch and transformers
+    from sentence_transformers import SentenceTransformer
+
+# a sentence ends at the whitespace after a ".", "?" or "!"
+_SENT_RE = re.compile(r"(?<=[.?!])\s+")
+
+
+@functools.lru_cache(maxsize=4)
+def _get_st_model(model_name, device=None, quantize=False) -> SentenceTransformer:
+    """Loads a sentence transformer model once per process, the chunkers
+    created for every document share it. On a GPU the model runs in half
+    precision, on CPU its linear layers can be quantized to int8: the
+    breakpoints depend only on the order of the distances, which the lower
+    precision barely changes"""
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(model_name, device=device)
+    if model.device.type == "cuda":
+        model.half()
+    elif quantize:
+        import torch
+
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    return model
+
+
+def _extract_pages(pdf_path, start, stop):
+    """Extracts the text of the pages from start to stop (excluded), run by
+    the worker processes of Chunking.document_reader"""
+    with fitz.open(pdf_path) as doc:
+        return [page.get_text("text") for page in doc.pages(start, stop)]
 
 
 class Chunking:
     """
     This class provides methods for preprocessing documents.
+
+    Attributes:
+        n_workers (int): Number of processes extracting the text of the pages.
+            PyMuPDF documents cannot be shared between threads, so each process
+            opens the document and reads a range of pages. Defaults to 1.
     """
 
+    n_workers = 1
+
     def document_reader(self, pdf_path):
         """
         Reads a document(PDF or txt) and extracts the content.
@@ -31,33 +77,49 @@ class Chunking:
                 - "line_num" (int): The line number.
                 - "sentence" (str): The extracted sentence.
         """
+        return list(self._iter_lines(pdf_path))
+
+    def _iter_lines(self, pdf_path):
+        """Yields the sentences of the document while its pages are read, in
+        the format of document_reader, without keeping them all in memory"""
+        for page_num, text in enumerate(self._iter_pages(pdf_path), 1):
+            for line_num, line in enumerate(_SENT_RE.split(text), 1):
+                line = line.strip()
+                if line:  # Ignore empty lines
+                    yield {
+                        "page": page_num,
+                        "line_num": line_num,
+                        "sentence": line,
+                    }
 
+    def _iter_pages(self, pdf_path):
+        """Yields the text of every page of the document"""
         # check if the file is a pdf
         if pdf_path.endswith(".pdf"):
-            doc = fitz.open(pdf_path)
-        if pdf_path.endswith(".txt"):
+            with fitz.open(pdf_path) as doc:
+                yield from self._read_pages(pdf_path, doc)
+        elif pdf_path.endswith(".txt"):
+            # a text file is read as a single page
             with open(pdf_path) as file:
-                doc = file.read()
-
-        data = []
-
-        for page_num in range(len(doc)):
-            page = doc.load_page(page_num)
-            text = page.get_text("text")
-
-            lines = re.split(r"(?<=[.?!])\s+", text)
+                yield file.read()
+        else:
+            raise ValueError("unsupported file type")
 
-            for line_num, line in enumerate(lines):
-                if line.strip():  # Ignore empty lines
-                    data.append(
-                        {
-                            "page": page_num + 1,
-                            "line_num": line_num + 1,
-                            "sentence": line.strip(),
-                        }
-                    )
+    def _read_pages(self, pdf_path, doc):
+        """Returns the text of every page of the document, split among
+        n_workers processes when there are more than one"""
+        n_pages = len(doc)
+        workers = min(self.n_workers, n_pages)
+        if workers <= 1:
+            # read lazily, the pages are chunked as they come
+            return (page.get_text("text") for page in doc)
 
-        return data
+        step = -(-n_pages // workers)
+        starts = range(0, n_pages, step)
+        stops = [min(start + step, n_pages) for start in starts]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = pool.map(_extract_pages, repeat(pdf_path), starts, stops)
+            return [text for part in parts for text in part]
 
 
 class NaiveChunking(Chunking):
@@ -80,7 +142,12 @@ class NaiveChunking(Chunking):
     """
 
     def __init__(
-        self, pdf_path: str, chunk_size: int, overlap_size: int, mode: str = "words"
+        self,
+        pdf_path: str,
+        chunk_size: int,
+        overlap_size: int,
+        mode: str = "words",
+        n_workers: int = 1,
     ):
         """
         Initialize the Preprocessing object.
@@ -90,18 +157,21 @@ class NaiveChunking(Chunking):
             chunk_size (int): The size of each chunk in number of words.
             overlap_size (int): The size of the overlap between chunks in number of words.
             mode (str, optional): The mode of preprocessing. Defaults to "words", ["words" or "characters"].
+            n_workers (int, optional): Number of processes reading the pages. Defaults to 1.
         """
         self.pdf_path = pdf_path
         self.chunk_size = chunk_size
         self.overlap_size = overlap_size
         self.mode = mode
+        self.n_workers = n_workers
 
     def create_chunks_by_words(self, data, chunk_size, overlap_size):
         """
         Create chunks of text ensuring each chunk starts and ends with a complete word, with overlapping.
 
         Args:
-            data (list): A list of dictionaries containing page number, line number, and text.
+            data (iterable): The dictionaries containing page number, line number, and text,
+                they are read once and can be produced while the chunks are created.
             chunk_size (int): Desired chunk size in terms of number of words.
             overlap_size (int): Desired overlap size in terms of number of words.
 
@@ -109,18 +179,23 @@ class NaiveChunking(Chunking):
             list: A list of dictionaries containing page number, start line, end line, and text chunk.
         """
         chunks = []
-        current_chunk = []
-        current_page = data[0]["page"]
-        start_line = data[0]["line_num"]
-        word_count = 0
-
-        for i, entry in enumerate(data):
-            words = entry["sentence"].split()
-            current_chunk.extend(words)
-            word_count += len(words)
-
-            if word_count >= chunk_size:
-                chunk_text = " ".join(current_chunk[:chunk_size])
+        data = iter(data)
+        first = next(data, None)
+        if first is None:
+            return chunks
+
+        # the words of the current chunk are words[head:], moving head instead
+        # of slicing the list avoids copying the overlap at every chunk
+        words = []
+        head = 0
+        current_page = first["page"]
+        start_line = first["line_num"]
+
+        for entry in chain([first], data):
+            words.extend(entry["sentence"].split())
+
+            if len(words) - head >= chunk_size:
+                chunk_text = " ".join(words[head : head + chunk_size])
                 end_line = entry["line_num"]
                 chunks.append(
                     {
@@ -130,18 +205,27 @@ class NaiveChunking(Chunking):
                         "text": chunk_text,
                     }
                 )
-                current_chunk = current_chunk[chunk_size - overlap_size :]
-                word_count = len(current_chunk)
+                # clamp like words[head:][step:], a negative step counts from the end
+                step = chunk_size - overlap_size
+                if step >= 0:
+                    head = min(head + step, len(words))
+                else:
+                    head = max(head, len(words) + step)
+                if head > len(words) - head:
+                    # drop the consumed words once they outnumber the others
+                    del words[:head]
+                    head = 0
                 current_page = entry["page"]
                 start_line = entry["line_num"]
 
-        if current_chunk:
-            chunk_text = " ".join(current_chunk)
+        # entry is the last sentence of the document
+        if head < len(words):
+            chunk_text = " ".join(words[head:])
             chunks.append(
                 {
                     "page": current_page,
                     "start_line": start_line,
-                    "end_line": data[-1]["line_num"],
+                    "end_line": entry["line_num"],
                     "text": chunk_text,
                 }
             )
@@ -153,7 +237,8 @@ class NaiveChunking(Chunking):
         Create chunks of text ensuring each chunk starts and ends with a complete word, with overlapping.
 
         Args:
-            data (list): A list of dictionaries containing page number, line number, and text.
+            data (iterable): The dictionaries containing page number, line number, and text,
+                they are read once and can be produced while the chunks are created.
             chunk_size (int): Desired chunk size in terms of number of characters.
             overlap_size (int): Desired overlap size in terms of number of characters.
 
@@ -161,17 +246,26 @@ class NaiveChunking(Chunking):
             list: A list of dictionaries containing page number, start line, end line, and text chunk.
         """
         chunks = []
-        current_chunk = ""
-        current_page = data[0]["page"]
-        start_line = data[0]["line_num"]
+        data = iter(data)
+        first = next(data, None)
+        if first is None:
+            return chunks
+
+        # the pieces of the current chunk are joined only when a chunk is
+        # emitted, appending to a string would copy it at every sentence
+        buffer = []
+        current_page = first["page"]
+        start_line = first["line_num"]
         char_count = 0
 
-        for i, entry in enumerate(data):
+        for entry in chain([first], data):
             text = entry["sentence"]
-            current_chunk += text + " "
+            buffer.append(text)
+            buffer.append(" ")
             char_count += len(text) + 1  # Include space
 
             if char_count >= chunk_size:
+                current_chunk = "".join(buffer)
                 chunk_text = current_chunk[:chunk_size].rsplit(" ", 1)[0]
                 end_line = entry["line_num"]
                 chunks.append(
@@ -183,16 +277,19 @@ class NaiveChunking(Chunking):
                     }
                 )
                 current_chunk = current_chunk[len(chunk_text) - overlap_size :].lstrip()
+                buffer = [current_chunk]
                 char_count = len(current_chunk)
                 current_page = entry["page"]
                 start_line = entry["line_num"]
 
+        # entry is the last sentence of the document
+        current_chunk = "".join(buffer)
         if current_chunk.strip():
             chunks.append(
                 {
                     "page": current_page,
                     "start_line": start_line,
-                    "end_line": data[-1]["line_num"],
+                    "end_line": entry["line_num"],
                     "text": current_chunk.strip(),
                 }
             )
@@ -214,7 +311,8 @@ class NaiveChunking(Chunking):
         Returns:
             list: A list of dictionaries containing page number, start line, end line, and text chunk.
         """
-        data = self.document_reader(self.pdf_path)
+        # the sentences are chunked while the document is read
+        data = self._iter_lines(self.pdf_path)
 
         if self.mode == "words":
             chunks = self.create_chunks_by_words(
@@ -235,6 +333,11 @@ class SemanticChunking(Chunking):
         self,
         pdf_path: str,
         model_name: str = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2",
+        batch_size: int = 64,
+        device: str = None,
+        n_workers: int = 1,
+        quantize: bool = False,
+        cache_dir: str = None,
     ):
         """
         Initialize the Preprocessing class.
@@ -243,9 +346,25 @@ class SemanticChunking(Chunking):
             pdf_path (str): The path to the PDF file.
             model_name (str, optional): The name of the sentence transformer model to use.
                 Defaults to "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2".
+            batch_size (int, optional): Number of sentences embedded together by the model.
+                Defaults to 64.
+            device (str, optional): Device of the model (e.g. "cpu" or "cuda").
+                Defaults to None, chosen by sentence-transformers.
+            n_workers (int, optional): Number of processes reading the pages. Defaults to 1.
+            quantize (bool, optional): If True and the model runs on CPU, quantize its
+                linear layers to int8. On a GPU the model always runs in float16.
+                Defaults to False.
+            cache_dir (str, optional): Directory where the embeddings of the documents
+                are saved, a document already embedded with the same model, device
+                and quantization is not embedded again. Defaults to None (no cache).
         """
         self.pdf_path = pdf_path
-        self.model = SentenceTransformer(model_name)
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.n_workers = n_workers
+        self.cache_dir = cache_dir
+        self.quantize = quantize
+        self.model = _get_st_model(model_name, device, quantize)
 
     def create_chunks(self):
         """
@@ -273,67 +392,97 @@ class SemanticChunking(Chunking):
 
         sentences = self.combine_sentences(text)
 
-        for sen in sentences:
-            sen["combined_sentence_embedding"] = self.model.encode(
-                sen["combined_sentence"]
-            )
+        embeddings = self.embed([sen["combined_sentence"] for sen in sentences])
+        for sen, embedding in zip(sentences, embeddings):
+            sen["combined_sentence_embedding"] = embedding
 
         distances, sentences = self.calculate_cosine_distances(sentences)
 
-        breakpoint_distance_threshold = np.std(distances) + np.mean(distances)
-        indices_above_thresh = [
-            i for i, x in enumerate(distances) if x > breakpoint_distance_threshold
-        ]
+        distances = np.asarray(distances)
+        if distances.size:
+            breakpoint_distance_threshold = distances.std() + distances.mean()
+            indices_above_thresh = np.flatnonzero(
+                distances > breakpoint_distance_threshold
+            )
+        else:
+            # a single sentence has no distance, it is the only chunk
+            indices_above_thresh = np.empty(0, dtype=np.intp)
 
-        # Initialize the start index
-        start_index = 0
+        # A group ends at every breakpoint, the last one at the end of the document
+        bounds = np.concatenate(([0], indices_above_thresh + 1, [len(sentences)]))
 
         # Create a list to hold the grouped sentences
         chunks = []
 
-        # Iterate through the breakpoints to slice the sentences
-        for index in indices_above_thresh:
-            # The end index is the current breakpoint
-            end_index = index
-
-            # Slice the sentence_dicts from the current start index to the end index
-            group = sentences[start_index : end_index + 1]
-            combined_text = " ".join([d["sentence"] for d in group])
-            start_line = group[0]["line_num"]
-            end_line = group[-1]["line_num"]
-            page = group[0]["page"]
-
-            c = {
-                "page": page,
-                "start_line": start_line,
-                "end_line": end_line,
-                "text": combined_text,
-            }
-
-            chunks.append(c)
-
-            # Update the start index for the next group
-            start_index = index + 1
-
-        # The last group, if any sentences remain
-        if start_index < len(sentences):
-            combined_text = " ".join([d["sentence"] for d in sentences[start_index:]])
-            start_line = group[0]["line_num"]
-            end_line = group[-1]["line_num"]
-            page = group[0]["page"]
-
-            c = {
-                "page": page,
-                "start_line": start_line,
-                "end_line": end_line,
-                "text": combined_text,
-            }
-
-            chunks.append(c)
-            # chunks.append(combined_text)
+        for start_index, end_index in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            group = sentences[start_index:end_index]
+            if not group:
+                continue
+            chunks.append(
+                {
+                    "page": group[0]["page"],
+                    "start_line": group[0]["line_num"],
+                    "end_line": group[-1]["line_num"],
+                    "text": " ".join([d["sentence"] for d in group]),
+                }
+            )
 
         return chunks, sentences
 
+    def embed(self, texts):
+        """
+        Embeds the combined sentences of the document. With a cache_dir, the
+        embeddings are saved there and read back when the same document is
+        chunked again with the same model, device and quantization.
+
+        Args:
+            texts (list): The combined sentences of the document.
+
+        Returns:
+            numpy.ndarray: The normalized embeddings, one row per sentence.
+        """
+        if self.cache_dir is None:
+            return self._encode(texts)
+
+        with open(self.pdf_path, "rb") as file:
+            digest = hashlib.file_digest(file, "sha256").hexdigest()
+        model = self.model_name.replace("/", "_")
+        # float16 on a GPU and int8 on CPU give slightly different embeddings
+        device = self.model.device.type
+        quantized = "-int8" if self.quantize else ""
+        path = os.path.join(self.cache_dir, f"{digest}-{model}-{device}{quantized}.npz")
+
+        if os.path.exists(path):
+            with np.load(path) as cached:
+                # the sentences change if the chunking does, then embed again
+                if cached["texts"].tolist() == texts:
+                    return cached["embeddings"]
+
+        embeddings = self._encode(texts)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # write aside and rename, a reader never sees a partly written file
+        fd, tmp = tempfile.mkstemp(suffix=".npz", dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, "wb") as file:
+                np.savez_compressed(
+                    file, embeddings=embeddings, texts=np.asarray(texts)
+                )
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return embeddings
+
+    def _encode(self, texts):
+        # a single call lets the model embed the sentences in batches
+        return self.model.encode(
+            texts,
+            batch_size=self.batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False,
+        )
+
     def calculate_cosine_distances(self, sentences):
         """
         Calculates the cosine distances between consecutive sentences in a list.
@@ -346,51 +495,36 @@ class SemanticChunking(Chunking):
                 - distances (list): A list of cosine distances between consecutive sentences.
                 - sentences (list): The input list of sentences with the 'distance_to_next' key added to each sentence dictionary.
         """
-        distances = []
-        for i in range(len(sentences) - 1):
-            embedding_current = sentences[i]["combined_sentence_embedding"]
-            embedding_next = sentences[i + 1]["combined_sentence_embedding"]
-
-            # Calculate cosine similarity
-            similarity = cosine_similarity([embedding_current], [embedding_next])[0][0]
+        if len(sentences) < 2:
+            return [], sentences
 
-            # Convert to cosine distance
-            distance = 1 - similarity
+        embeddings = np.asarray(
+            [sen["combined_sentence_embedding"] for sen in sentences], dtype=np.float32
+        )
+        # normalize the rows, so that the similarity of consecutive sentences
+        # is the dot product of their embeddings
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        embeddings /= norms
 
-            # Append cosine distance to the list
-            distances.append(distance)
+        similarities = np.einsum("ij,ij->i", embeddings[:-1], embeddings[1:])
+        distances = (1.0 - similarities).tolist()
 
-            # Store distance in the dictionary
-            sentences[i]["distance_to_next"] = distance
+        # Store distance in the dictionary
+        for sen, distance in zip(sentences, distances):
+            sen["distance_to_next"] = distance
 
         return distances, sentences
 
     def combine_sentences(self, sentences, buffer_size=1):
-        # Go through each sentence dict
-        for i in range(len(sentences)):
-            # Create a string that will hold the sentences which are joined
-            combined_sentence = ""
-
-            # Add sentences before the current one, based on the buffer size.
-            for j in range(i - buffer_size, i):
-                # Check if the index j is not negative (to avoid index out of range like on the first one)
-                if j >= 0:
-                    # Add the sentence at index j to the combined_sentence string
-                    combined_sentence += sentences[j]["sentence"] + " "
-
-            # Add the current sentence
-            combined_sentence += sentences[i]["sentence"]
-
-            # Add sentences after the current one, based on the buffer size
-            for j in range(i + 1, i + 1 + buffer_size):
-                # Check if the index j is within the range of the sentences list
-                if j < len(sentences):
-                    # Add the sentence at index j to the combined_sentence string
-                    combined_sentence += " " + sentences[j]["sentence"]
-
-            # Then add the whole thing to your dict
-            # Store the combined sentence in the current sentence dict
-            sentences[i]["combined_sentence"] = combined_sentence
+        texts = [sen["sentence"] for sen in sentences]
+
+        # Store in each sentence dict the sentence joined with the buffer_size
+        # sentences before and after it
+        for i, sen in enumerate(sentences):
+            sen["combined_sentence"] = " ".join(
+                texts[max(0, i - buffer_size) : i + buffer_size + 1]
+            )
 
         return sentences
 
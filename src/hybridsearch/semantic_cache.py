@@ -0,0 +1,162 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+from abc import ABC, abstractmethod
+
+logger = logging.getLogger(__name__)
+
+
+def _namespace(*parts):
+    """Builds the namespace of a search from the parameters that change its
+    results, so that a cached answer is only reused for the same settings"""
+    key = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def _lookup(cache, query, collection_name, namespace):
+    """Looks up a query in the cache. A cache that fails (e.g. Redis is down)
+    is logged and treated as a miss, the search goes to the microservice"""
+    try:
+        return cache.lookup(query, collection_name, namespace)
+    except Exception:
+        logger.warning("semantic cache lookup failed", exc_info=True)
+        return None
+
+
+def _store(cache, query, collection_name, namespace, description):
+    """Stores the results of a query, logging the errors of the cache"""
+    try:
+        cache.store(query, collection_name, namespace, description)
+    except Exception:
+        logger.warning("semantic cache store failed", exc_info=True)
+
+
+def _invalidate(cache, collection_name):
+    """Removes the results of the searches on a collection, logging the errors
+    of the cache"""
+    try:
+        cache.invalidate(collection_name)
+    except Exception:
+        logger.warning("semantic cache invalidation failed", exc_info=True)
+
+
+class SemanticCacheProvider(ABC):
+    """
+    Base class of the caches that can be put in front of the searches of
+    HybridSearch. A cache answers a query with the results stored for a
+    similar enough query searched before with the same settings. The results
+    of a collection are invalidated when the client writes to it.
+    """
+
+    @abstractmethod
+    def lookup(self, query: str, collection_name: str, namespace: str):
+        """
+        Looks for the results of a query similar to the given one.
+
+        Args:
+            query (str): The query to search.
+            collection_name (str): The collection searched.
+            namespace (str): Identifier of the collection and search settings.
+
+        Returns:
+            The cached results, or None if there are none.
+        """
+
+    @abstractmethod
+    def store(self, query: str, collection_name: str, namespace: str, description):
+        """
+        Stores the results of a query.
+
+        Args:
+            query (str): The query that was searched.
+            collection_name (str): The collection searched.
+            namespace (str): Identifier of the collection and search settings.
+            description: The results returned by the microservice.
+        """
+
+    @abstractmethod
+    def invalidate(self, collection_name: str):
+        """
+        Removes the stored results of the searches on a collection, called
+        when documents are added to it or it is created or deleted.
+
+        Args:
+            collection_name (str): The collection modified.
+        """
+
+
+class RedisVLSemanticCache(SemanticCacheProvider):
+    """
+    Semantic cache stored in Redis, built on redisvl's SemanticCache.
+
+    Requires the optional dependency redisvl (extra "semantic-cache").
+    """
+
+    def __init__(
+        self,
+        name: str = "hybridsearch",
+        redis_url: str = "redis://localhost:6379",
+        distance_threshold: float = 0.1,
+        ttl: int = 3600,
+        vectorizer_model: str = "redis/langcache-embed-v2",
+    ):
+        """
+        Initialize the cache.
+
+        Args:
+            name (str, optional): Name of the Redis index. Defaults to "hybridsearch".
+            redis_url (str, optional): URL of Redis. Defaults to "redis://localhost:6379".
+            distance_threshold (float, optional): Maximum cosine distance between
+                two queries for a cached answer to be reused. Defaults to 0.1.
+            ttl (int, optional): Seconds after which the entries expire, it
+                bounds how stale the results are when the collections are
+                modified by other clients. Defaults to 3600.
+            vectorizer_model (str, optional): Model used to embed the queries.
+                Defaults to "redis/langcache-embed-v2".
+        """
+        from redisvl.extensions.cache.llm import SemanticCache
+        from redisvl.utils.vectorize import HFTextVectorizer
+
+        self._cache = SemanticCache(
+            name=name,
+            redis_url=redis_url,
+            distance_threshold=distance_threshold,
+            ttl=ttl,
+            vectorizer=HFTextVectorizer(vectorizer_model),
+            filterable_fields=[
+                {"name": "collection", "type": "tag"},
+                {"name": "namespace", "type": "tag"},
+            ],
+        )
+
+    def lookup(self, query: str, collection_name: str, namespace: str):
+        from redisvl.query.filter import Tag
+
+        hits = self._cache.check(
+            prompt=query, num_results=1, filter_expression=Tag("namespace") == namespace
+        )
+        if not hits:
+            return None
+        return json.loads(hits[0]["response"])
+
+    def store(self, query: str, collection_name: str, namespace: str, description):
+        self._cache.store(
+            prompt=query,
+            response=json.dumps(description),
+            filters={"collection": collection_name, "namespace": namespace},
+        )
+
+    def invalidate(self, collection_name: str):
+        from redisvl.query import FilterQuery
+        from redisvl.query.filter import Tag
+
+        query = FilterQuery(
+            filter_expression=Tag("collection") == collection_name,
+            return_fields=["id"],
+            num_results=1000,
+        )
+        # the entries found are dropped, query again until none is left
+        while keys := [hit["id"] for hit in self._cache.index.query(query)]:
+            self._cache.drop(keys=keys)
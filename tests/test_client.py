@@ -0,0 +1,340 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import pytest
+import requests
+
+from hybridsearch import AsyncHybridSearch, HybridSearch, SemanticCacheProvider
+
+"""
+This file contains the tests of the clients against a local fake microservice
+"""
+
+
+class FakeMicroservice(ThreadingHTTPServer):
+    """
+    A microservice answering like the typesense+fastapi one. Every request is
+    recorded in requests, and waits for gate before being answered
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), Handler)
+        self.requests = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self.bulk = True
+
+    def count(self, path):
+        return sum(1 for _, request_path in self.requests if request_path == path)
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def answer(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        self.server.requests.append(("GET", path))
+        self.server.gate.wait(5)
+        if path == "/api-key":
+            valid = self.headers.get("x-typesense-api-key") == "xyz"
+            self.answer(200 if valid else 401, {})
+        elif path.startswith("/collections/"):
+            name = path.rsplit("/", 1)[1]
+            self.answer(200, {"name": name, "num_documents": 0})
+        else:
+            self.answer(200, {})
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.requests.append(("POST", path))
+        self.server.gate.wait(5)
+        if path == "/create-documents-bulk" and self.server.bulk:
+            self.answer(200, [{"id": doc["id"]} for doc in json.loads(body)])
+        elif path == "/create-document":
+            self.answer(200, {})
+        elif path == "/collections-semanticsearch":
+            self.answer(200, [{"text": "from the microservice", "score": 0.5}])
+        else:
+            self.answer(404, {"detail": "Not Found"})
+
+
+@pytest.fixture
+def server():
+    server = FakeMicroservice()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(server):
+    with HybridSearch(api_key="xyz", port=server.server_address[1]) as client:
+        yield client
+
+
+def wait_for(condition):
+    """Waits until the fake microservice reaches the given condition"""
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_invalid_api_key_closes_the_session(server, monkeypatch):
+    """
+    This function tests the __init__ function of the HybridSearch class
+    It asserts that the session is closed when the API key is refused
+    """
+
+    closed = []
+    monkeypatch.setattr(requests.Session, "close", lambda self: closed.append(self))
+
+    with pytest.raises(Exception, match="Invalid API Key"):
+        HybridSearch("wrong", port=server.server_address[1])
+
+    assert len(closed) == 1
+
+
+def test_concurrent_reads_share_a_request(server, client):
+    """
+    This function tests the _read function of the HybridSearch class
+    It asserts that concurrent get_collection calls send a single request
+    """
+
+    server.gate.clear()
+    threads = []
+    results = []
+    for _ in range(8):
+        thread = threading.Thread(
+            target=lambda: results.append(client.get_collection("books"))
+        )
+        thread.start()
+        threads.append(thread)
+    wait_for(lambda: server.count("/collections/books") == 1)
+    # let the other callers find the request in flight
+    time.sleep(0.2)
+    server.gate.set()
+    for thread in threads:
+        thread.join()
+
+    assert server.count("/collections/books") == 1
+    assert len(results) == 8
+    assert all(result["status"] == 200 for result in results)
+
+
+def test_async_concurrent_reads_share_a_request(server):
+    """
+    This function tests the _read function of the AsyncHybridSearch class
+    It asserts that concurrent get_collection calls send a single request
+    """
+
+    async def read():
+        async with AsyncHybridSearch("xyz", port=server.server_address[1]) as client:
+            return await asyncio.gather(
+                *(client.get_collection("books") for _ in range(8))
+            )
+
+    results = asyncio.run(read())
+
+    assert server.count("/collections/books") == 1
+    assert all(result["status"] == 200 for result in results)
+
+
+def test_async_session_of_a_previous_loop_is_closed(server):
+    """
+    This function tests the _client function of the AsyncHybridSearch class
+    It asserts that the session of a previous event loop is closed, whether
+    that loop is still open or not
+    """
+
+    client = AsyncHybridSearch("xyz", port=server.server_address[1])
+    open_loop = asyncio.new_event_loop()
+    open_loop.run_until_complete(client.get_collection("books"))
+    first = client._session
+    asyncio.run(client.get_collection("movies"))
+    second = client._session
+    open_loop.run_until_complete(asyncio.sleep(0.1))
+    open_loop.close()
+    asyncio.run(client.get_collection("songs"))
+    asyncio.run(client.close())
+
+    assert first.closed
+    assert second.closed
+    assert not client._inflight
+
+
+def test_read_evicted_in_flight_is_not_cached(server, client):
+    """
+    This function tests the _read function of the HybridSearch class
+    It asserts that a read in flight during an eviction is not cached
+    """
+
+    server.gate.clear()
+    thread = threading.Thread(target=client.get_collection, args=("books",))
+    thread.start()
+    wait_for(lambda: server.count("/collections/books") == 1)
+    client.invalidate()
+    server.gate.set()
+    thread.join()
+
+    client.get_collection("books")
+
+    assert server.count("/collections/books") == 2
+
+
+def test_cached_answer_is_not_shared(server, client):
+    """
+    This function tests the _read function of the HybridSearch class
+    It asserts that changing an answer does not change the next one
+    """
+
+    first = client.get_collection("books")
+    first["description"]["num_documents"] = 100
+    second = client.get_collection("books")
+
+    assert server.count("/collections/books") == 1
+    assert second == {
+        "status": 200,
+        "description": {"name": "books", "num_documents": 0},
+    }
+
+
+def test_create_documents_in_batches(server, client):
+    """
+    This function tests the create_documents function of the HybridSearch class
+    It asserts that the documents are sent in batches and the results keep
+    their order
+    """
+
+    schemas = [{"id": str(i)} for i in range(5)]
+    response = client.create_documents("books", schemas, batch_size=2)
+
+    assert server.count("/create-documents-bulk") == 3
+    assert response == {"status": 200, "description": schemas}
+
+
+def test_create_documents_without_bulk_endpoint(server, client):
+    """
+    This function tests the create_documents function of the HybridSearch class
+    It asserts that only the first batch is sent to a missing bulk endpoint and
+    the documents are then created one by one
+    """
+
+    server.bulk = False
+    schemas = [{"id": str(i)} for i in range(6)]
+    response = client.create_documents("books", schemas, batch_size=2)
+
+    assert server.count("/create-documents-bulk") == 1
+    assert server.count("/create-document") == 6
+    assert response == {
+        "status": 200,
+        "description": ["Document created successfully"] * 6,
+    }
+
+
+class FailingCache(SemanticCacheProvider):
+    """A semantic cache whose backend is down"""
+
+    def lookup(self, query, collection_name, namespace):
+        raise ConnectionError("cache is down")
+
+    def store(self, query, collection_name, namespace, description):
+        raise ConnectionError("cache is down")
+
+    def invalidate(self, collection_name):
+        raise ConnectionError("cache is down")
+
+
+def test_failing_semantic_cache_is_skipped(server):
+    """
+    This function tests the _search function of the HybridSearch class
+    It asserts that a search returns the results of the microservice when the
+    semantic cache raises
+    """
+
+    with HybridSearch(
+        "xyz", port=server.server_address[1], semantic_cache=FailingCache()
+    ) as client:
+        response = client.semantic_search("books", "quick fox", 3)
+        client.create_document("books", {"id": "1"})
+
+    assert response == {
+        "status": 200,
+        "description": [{"text": "from the microservice", "score": 0.5}],
+    }
+
+
+def test_iter_search_matches_semantic_search(server, client):
+    """
+    This function tests the iter_search function of the HybridSearch class
+    It asserts that the streamed results equal the semantic_search ones,
+    scores included
+    """
+
+    pytest.importorskip("ijson")
+
+    streamed = list(client.iter_search("books", "quick fox", 3))
+
+    assert streamed == client.semantic_search("books", "quick fox", 3)["description"]
+    assert all(isinstance(hit["score"], float) for hit in streamed)
+
+
+class MemoryCache(SemanticCacheProvider):
+    """A semantic cache matching only identical queries, kept in a dict"""
+
+    def __init__(self):
+        self.entries = {}
+
+    def lookup(self, query, collection_name, namespace):
+        return self.entries.get((collection_name, namespace, query))
+
+    def store(self, query, collection_name, namespace, description):
+        self.entries[(collection_name, namespace, query)] = description
+
+    def invalidate(self, collection_name):
+        for key in [key for key in self.entries if key[0] == collection_name]:
+            del self.entries[key]
+
+
+def test_semantic_cache_serves_repeated_searches(server):
+    """
+    This function tests the _search function of the HybridSearch class
+    It asserts that a repeated search is served by the semantic cache, that
+    other settings miss it and that a write to the collection invalidates it
+    """
+
+    path = "/collections-semanticsearch"
+    with HybridSearch(
+        "xyz", port=server.server_address[1], semantic_cache=MemoryCache()
+    ) as client:
+        first = client.semantic_search("books", "quick fox", 3)
+        second = client.semantic_search("books", "quick fox", 3)
+        assert server.count(path) == 1
+        assert second == first
+
+        client.semantic_search("books", "quick fox", 5)
+        assert server.count(path) == 2
+
+        client.create_document("books", {"id": "1"})
+        client.semantic_search("books", "quick fox", 3)
+        assert server.count(path) == 3
@@ -0,0 +1,241 @@
+from __future__ import annotations
+
+import warnings
+from types import SimpleNamespace
+
+import numpy as np
+
+from hybridsearch import preprocessing
+from hybridsearch.preprocessing import NaiveChunking, SemanticChunking
+
+"""
+This file contains the tests for the chunking of the documents
+"""
+
+DATA = [
+    {"page": 1, "line_num": 1, "sentence": "The quick brown fox."},
+    {"page": 1, "line_num": 2, "sentence": "It jumps over the lazy dog."},
+    {"page": 2, "line_num": 1, "sentence": "Then it runs away."},
+]
+
+
+def test_create_chunks_by_characters():
+    """
+    This function tests the create_chunks_by_characters function of the NaiveChunking class
+    It asserts that the chunks end on a complete word and overlap with the next one
+    """
+
+    chunker = NaiveChunking("", 30, 5, "characters")
+    chunks = chunker.create_chunks_by_characters(DATA, 30, 5)
+
+    assert chunks == [
+        {
+            "page": 1,
+            "start_line": 1,
+            "end_line": 2,
+            "text": "The quick brown fox. It jumps",
+        },
+        {
+            "page": 1,
+            "start_line": 2,
+            "end_line": 1,
+            "text": "jumps over the lazy dog. Then",
+        },
+        {"page": 2, "start_line": 1, "end_line": 1, "text": "Then it runs away."},
+    ]
+
+
+def test_create_chunks_by_words():
+    """
+    This function tests the create_chunks_by_words function of the NaiveChunking class
+    It asserts that the chunks have chunk_size words and overlap by overlap_size words
+    """
+
+    chunker = NaiveChunking("", 4, 1)
+    chunks = chunker.create_chunks_by_words(DATA, 4, 1)
+
+    assert [chunk["text"] for chunk in chunks] == [
+        "The quick brown fox.",
+        "fox. It jumps over",
+        "over the lazy dog.",
+        "dog. Then it runs away.",
+    ]
+
+
+SENTENCES = [
+    {"page": 1, "line_num": 1, "sentence": "Foxes are quick."},
+    {"page": 1, "line_num": 2, "sentence": "They hunt at night."},
+    {"page": 2, "line_num": 3, "sentence": "Dogs are lazy."},
+    {"page": 2, "line_num": 4, "sentence": "They sleep all day."},
+]
+
+
+class FakeModel:
+    """A sentence transformer that returns fixed embeddings"""
+
+    def __init__(self, rows, device="cpu"):
+        self.rows = np.asarray(rows, dtype=np.float32)
+        self.device = SimpleNamespace(type=device)
+        self.calls = 0
+
+    def encode(self, texts, **kwargs):
+        self.calls += 1
+        return self.rows[: len(texts)]
+
+
+def semantic_chunker(monkeypatch, sentences, rows, pdf_path="", **kwargs):
+    """
+    This function returns a SemanticChunking that reads the given sentences
+    and embeds them with the given rows, without loading a model
+    """
+
+    monkeypatch.setattr(
+        preprocessing,
+        "_get_st_model",
+        lambda model_name, device, quantize: FakeModel(rows, device or "cpu"),
+    )
+    monkeypatch.setattr(
+        SemanticChunking,
+        "document_reader",
+        lambda self, pdf_path: [dict(sen) for sen in sentences],
+    )
+    return SemanticChunking(pdf_path, **kwargs)
+
+
+def test_semantic_chunks_metadata(monkeypatch):
+    """
+    This function tests the create_chunks function of the SemanticChunking class
+    It asserts that the last chunk takes its page and lines from its own sentences
+    """
+
+    chunker = semantic_chunker(monkeypatch, SENTENCES, [[1, 0], [1, 0], [0, 1], [0, 1]])
+    chunks, _ = chunker.create_chunks()
+
+    assert chunks == [
+        {
+            "page": 1,
+            "start_line": 1,
+            "end_line": 2,
+            "text": "Foxes are quick. They hunt at night.",
+        },
+        {
+            "page": 2,
+            "start_line": 3,
+            "end_line": 4,
+            "text": "Dogs are lazy. They sleep all day.",
+        },
+    ]
+
+
+def test_semantic_chunks_without_breakpoint(monkeypatch):
+    """
+    This function tests the create_chunks function of the SemanticChunking class
+    It asserts that a document without breakpoint is a single chunk
+    """
+
+    chunker = semantic_chunker(monkeypatch, SENTENCES, [[1, 0]] * 4)
+    chunks, _ = chunker.create_chunks()
+
+    assert chunks == [
+        {
+            "page": 1,
+            "start_line": 1,
+            "end_line": 4,
+            "text": " ".join(sen["sentence"] for sen in SENTENCES),
+        }
+    ]
+
+
+def test_semantic_chunks_single_sentence(monkeypatch):
+    """
+    This function tests the create_chunks function of the SemanticChunking class
+    It asserts that a one sentence document is a single chunk, without warnings
+    """
+
+    chunker = semantic_chunker(monkeypatch, SENTENCES[:1], [[1, 0]])
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        chunks, _ = chunker.create_chunks()
+
+    assert chunks == [
+        {"page": 1, "start_line": 1, "end_line": 1, "text": "Foxes are quick."}
+    ]
+
+
+ROWS = [[1, 0], [1, 0], [0, 1], [0, 1]]
+
+
+def pdf_file(tmp_path):
+    """This function writes a document for the embeddings cache to hash"""
+
+    path = tmp_path / "document.pdf"
+    path.write_bytes(b"%PDF-1.4 foxes and dogs")
+    return str(path)
+
+
+def test_embed_reads_the_cache(monkeypatch, tmp_path):
+    """
+    This function tests the embed function of the SemanticChunking class
+    It asserts that chunking a document again reads its embeddings from the
+    cache instead of encoding them
+    """
+
+    chunker = semantic_chunker(
+        monkeypatch,
+        SENTENCES,
+        ROWS,
+        pdf_file(tmp_path),
+        cache_dir=str(tmp_path / "cache"),
+    )
+    first, _ = chunker.create_chunks()
+    second, _ = chunker.create_chunks()
+
+    assert chunker.model.calls == 1
+    assert second == first
+
+
+def test_embed_changed_sentences(monkeypatch, tmp_path):
+    """
+    This function tests the embed function of the SemanticChunking class
+    It asserts that the sentences are embedded again when they changed
+    """
+
+    chunker = semantic_chunker(
+        monkeypatch,
+        SENTENCES,
+        ROWS,
+        pdf_file(tmp_path),
+        cache_dir=str(tmp_path / "cache"),
+    )
+    chunker.create_chunks()
+    monkeypatch.setattr(
+        SemanticChunking,
+        "document_reader",
+        lambda self, pdf_path: [dict(sen) for sen in SENTENCES[1:]],
+    )
+    chunks, _ = chunker.create_chunks()
+
+    assert chunker.model.calls == 2
+    assert chunks[0]["text"].startswith("They hunt at night.")
+
+
+def test_embed_cache_per_device_and_quantization(monkeypatch, tmp_path):
+    """
+    This function tests the embed function of the SemanticChunking class
+    It asserts that another device or quantization does not read the
+    embeddings of the first one
+    """
+
+    pdf_path = pdf_file(tmp_path)
+    cache_dir = tmp_path / "cache"
+    chunkers = [
+        semantic_chunker(
+            monkeypatch, SENTENCES, ROWS, pdf_path, cache_dir=str(cache_dir), **kwargs
+        )
+        for kwargs in ({}, {"device": "cuda"}, {"quantize": True})
+    ]
+    for chunker in chunkers:
+        chunker.create_chunks()
+
+    assert [chunker.model.calls for chunker in chunkers] == [1, 1, 1]
+    assert len(list(cache_dir.glob("*.npz"))) == 3